@@ -1,30 +1,70 @@
 import os
 import json
 import time
-from src.processor import OutlineExtractor
-
-# Use absolute paths from environment variables (Docker will set these up)
-INPUT_DIR = os.getenv("INPUT_DIR", "input")
-import os
-import json
-import time
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from src.processor import OutlineExtractor
 
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib encoder
+    orjson = None
+
 # Use absolute paths from environment variables (Docker will set these up)
 INPUT_DIR = os.getenv("INPUT_DIR", "input")
 OUTPUT_DIR = os.getenv("OUTPUT_DIR", "output")
 
+# Parsing is CPU and memory bound; more than 4 workers stops paying off
+MAX_WORKERS = 4
+
+def _write_json(result, output_path):
+    """Write a result as indented UTF-8 JSON, using orjson when available."""
+    if orjson is not None:
+        with open(output_path, 'wb') as f:
+            f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
+    else:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+def _process_one(pdf_file):
+    """
+    Worker: extract the outline of a single PDF and write its JSON file.
+    The extractor is built here so fitz documents never cross process boundaries.
+    Returns (pdf_file, output_path, elapsed, error).
+    """
+    start_time = time.time()
+
+    input_path = os.path.join(INPUT_DIR, pdf_file)
+    output_filename = os.path.splitext(pdf_file)[0] + '.json'
+    output_path = os.path.join(OUTPUT_DIR, output_filename)
+
+    print(f"Processing '{input_path}'...")
+
+    try:
+        with OutlineExtractor(input_path) as extractor:
+            result = extractor.get_structured_outline()
+
+        _write_json(result, output_path)
+    except Exception as e:
+        return pdf_file, output_path, time.time() - start_time, str(e)
+
+    return pdf_file, output_path, time.time() - start_time, None
+
 def process_all_pdfs():
     """
     Main processing loop with improved error handling and permission management.
+    Each PDF is independent, so files are handled in parallel by a worker pool.
     """
     # Ensure output directory exists with proper permissions
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     os.chmod(OUTPUT_DIR, 0o777)  # Ensure writable by all
 
     try:
-        pdf_files = [f for f in os.listdir(INPUT_DIR) if f.lower().endswith('.pdf')]
+        # DirEntry caches its file type, so subdirectories are skipped cheaply
+        with os.scandir(INPUT_DIR) as entries:
+            pdf_files = [e.name for e in entries
+                         if e.is_file() and e.name.lower().endswith('.pdf')]
     except PermissionError:
         print(f"Permission denied reading input directory: {INPUT_DIR}")
         sys.exit(1)
@@ -32,71 +72,25 @@ def process_all_pdfs():
         print(f"Input directory not found: {INPUT_DIR}")
         sys.exit(1)
 
-    for pdf_file in pdf_files:
-        start_time = time.time()
-        
-        input_path = os.path.join(INPUT_DIR, pdf_file)
-        output_filename = os.path.splitext(pdf_file)[0] + '.json'
-        output_path = os.path.join(OUTPUT_DIR, output_filename)
-
-        print(f"Processing '{input_path}'...")
-
-        try:
-            extractor = OutlineExtractor(input_path)
-            result = extractor.get_structured_outline()
-            
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(result, f, indent=4, ensure_ascii=False)
-            
-            # Set permissions on the output file
-            os.chmod(output_path, 0o666)
-            
-            processing_time = time.time() - start_time
-            print(f"-> Successfully created '{output_path}' in {processing_time:.2f} seconds.")
-
-        except Exception as e:
-            print(f"-> Error processing {pdf_file}: {e}", file=sys.stderr)
-
-if __name__ == "__main__":
-    process_all_pdfs()
-    OUTPUT_DIR = os.getenv("OUTPUT_DIR", "output")
-
-def process_all_pdfs():
-    """
-    Main processing loop.
-    Iterates through PDF files in the input directory, extracts their outlines,
-    and saves the results as JSON files in the output directory. [cite: 292]
-    """
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
-
-    try:
-        pdf_files = [f for f in os.listdir(INPUT_DIR) if f.lower().endswith('.pdf')]
-    except PermissionError:
-        print(f"Permission denied reading input directory: {INPUT_DIR}")
+    if not pdf_files:
         return
 
-    for pdf_file in pdf_files:
-        start_time = time.time()
-        
-        input_path = os.path.join(INPUT_DIR, pdf_file)
-        output_filename = os.path.splitext(pdf_file)[0] + '.json'
-        output_path = os.path.join(OUTPUT_DIR, output_filename)
-
-        print(f"Processing '{input_path}'...")
+    # fork is unsafe or unavailable with PyMuPDF's native state on
+    # macOS/Windows, so always start workers with spawn
+    workers = min(os.cpu_count() or 1, MAX_WORKERS, len(pdf_files))
 
-        try:
-            extractor = OutlineExtractor(input_path)
-            result = extractor.get_structured_outline()
-            
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(result, f, indent=4, ensure_ascii=False)
-            
-            processing_time = time.time() - start_time
-            print(f"-> Successfully created '{output_path}' in {processing_time:.2f} seconds.")
-
-        except Exception as e:
-            print(f"-> Error processing {pdf_file}: {e}")
+    # Clear the umask so output files are created 0o666 (writable by all)
+    # without a chmod per file; spawned workers inherit it
+    old_umask = os.umask(0o000)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as executor:
+            for pdf_file, output_path, processing_time, error in executor.map(_process_one, pdf_files):
+                if error is None:
+                    print(f"-> Successfully created '{output_path}' in {processing_time:.2f} seconds.")
+                else:
+                    print(f"-> Error processing {pdf_file}: {error}", file=sys.stderr)
+    finally:
+        os.umask(old_umask)
 
 if __name__ == "__main__":
     process_all_pdfs()
@@ -1,13 +1,28 @@
 import fitz
 import re
-import json
 import os
-import time
 import numpy as np
-from sklearn.cluster import DBSCAN
-from collections import defaultdict, Counter
-from scipy.spatial import distance
-import statistics
+from collections import Counter
+
+# Default "dict" extraction flags minus image blocks, which are never consumed
+_TEXT_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+# Outline level labels, indexed by ToC level - 1
+_LEVELS = ("H1", "H2", "H3")
+
+# Fraction of the first page's height searched for a title
+TITLE_REGION = 0.35
+
+# Compiled once: these run for every span, line and ToC entry
+_CLEAN_SPECIAL = re.compile(r'[^\w\s.,:;!?()-]')
+_CLEAN_WS = re.compile(r'\s+')
+# Anything _clean_text would change in already-stripped text: special
+# characters, whitespace runs, or whitespace other than a plain space
+_NEEDS_CLEANING = re.compile(r'[^\w\s.,:;!?()-]|\s{2,}|[^\S ]')
+_HEADING_RE = re.compile(
+    r'^(chapter|section|appendix|part|article|^\d+(\.\d+)*|^[A-Z]\.?)\b',
+    re.IGNORECASE
+)
 
 class RobustOutlineExtractor:
     """
@@ -24,81 +39,105 @@ class RobustOutlineExtractor:
             self.doc = fitz.open(pdf_path)
             self.toc = self.doc.get_toc()
             self.metadata = self.doc.metadata
-            self.font_profiles = self._analyze_fonts()
+            # Page text dicts and font profiles are built on first use, so
+            # PDFs with a usable ToC never pay for a full-document scan
+            self._pages_dict = None
+            self._font_profiles = None
+            self._inv_body_size = 0.0
         except Exception as e:
             raise RuntimeError(f"Failed to open PDF: {str(e)}")
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        """Close the document and drop caches so native memory is freed now"""
+        try:
+            self.doc.close()
+        except Exception:
+            pass
+        self._pages_dict = None
+        self._font_profiles = None
+
+    @property
+    def font_profiles(self):
+        """Font profile of the whole document, analyzed on first access"""
+        if self._font_profiles is None:
+            self._font_profiles = self._analyze_fonts()
+            # Heading scoring multiplies by this instead of dividing per line
+            body_size = self._font_profiles.get("body_size", 0)
+            self._inv_body_size = 1.0 / body_size if body_size > 0 else 0.0
+        return self._font_profiles
+
+    def _page_dict(self, p_num):
+        """Return a page's text dict, extracting it once and caching it"""
+        if self._pages_dict is None:
+            self._pages_dict = [None] * len(self.doc)
+        pdict = self._pages_dict[p_num]
+        if pdict is None:
+            page = self.doc[p_num]
+            # Parse the page into a TextPage once; any further extraction
+            # modes for this page should pass textpage=tp instead of reparsing
+            tp = page.get_textpage(flags=_TEXT_FLAGS)
+            pdict = page.get_text("dict", sort=True, textpage=tp)
+            # Drop the TextPage explicitly so MuPDF frees its native memory now
+            tp = None
+            self._pages_dict[p_num] = pdict
+        return pdict
+
     def _clean_text(self, text):
         """Normalize text with advanced cleaning"""
         if not text:
             return ""
         # Remove special characters and normalize whitespace
-        text = re.sub(r'[^\w\s.,:;!?()-]', '', text)
-        return re.sub(r'\s+', ' ', text).strip()
+        return _CLEAN_WS.sub(' ', _CLEAN_SPECIAL.sub('', text)).strip()
 
     def _analyze_fonts(self):
-        """Create comprehensive font profile with clustering"""
-        font_data = []
-        for page in self.doc:
-            blocks = page.get_text("dict", sort=True).get("blocks", [])
-            for block in blocks:
+        """Create comprehensive font profile from a font-size histogram"""
+        # Collect span attributes as parallel lists rather than a dict per span
+        sizes = []
+        flags = []
+        for p_num in range(len(self.doc)):
+            for block in self._page_dict(p_num).get("blocks", []):
                 if "lines" in block:
                     for line in block["lines"]:
                         for span in line["spans"]:
-                            font_data.append({
-                                "size": round(span["size"]),
-                                "font": span["font"],
-                                "flags": span["flags"],
-                                "bbox": span["bbox"],
-                                "text": span["text"]
-                            })
+                            sizes.append(round(span["size"]))
+                            flags.append(span["flags"])
         
-        if not font_data:
+        if not sizes:
             return {}
         
-        # Cluster font sizes to identify heading sizes
-        sizes = np.array([d["size"] for d in font_data]).reshape(-1, 1)
-        clustering = DBSCAN(eps=0.5, min_samples=5).fit(sizes)
-        size_clusters = defaultdict(list)
-        for i, label in enumerate(clustering.labels_):
-            if label >= 0:  # Ignore noise
-                size_clusters[label].append(font_data[i]["size"])
+        # Histogram of rounded font sizes; sizes seen fewer than 5 times are noise
+        size_hist = Counter(sizes)
         
-        # Find body text (most common cluster)
-        body_cluster = max(size_clusters, key=lambda k: len(size_clusters[k]))
-        body_size = statistics.median(size_clusters[body_cluster])
+        # Find body text (most common size)
+        body_size = size_hist.most_common(1)[0][0]
         
-        # Identify heading clusters (significantly larger than body)
-        heading_clusters = {
-            k: statistics.median(v) 
-            for k, v in size_clusters.items()
-            if statistics.median(v) > body_size * 1.2
+        # Identify heading sizes (significantly larger than body)
+        heading_sizes = {
+            size for size, count in size_hist.items()
+            if size > body_size * 1.2 and count >= 5
         }
         
         # Sort heading sizes and map to levels
-        sorted_sizes = sorted(heading_clusters.values(), reverse=True)
+        sorted_sizes = sorted(heading_sizes, reverse=True)
         size_map = {}
         if sorted_sizes:
             size_map["H1"] = sorted_sizes[0]
             size_map["H2"] = sorted_sizes[1] if len(sorted_sizes) > 1 else sorted_sizes[0]
             size_map["H3"] = sorted_sizes[2] if len(sorted_sizes) > 2 else sorted_sizes[-1]
         
-        # Analyze font styles
-        font_styles = Counter()
-        for d in font_data:
-            flags = d["flags"]
-            style = ""
-            if flags & 2**0: style += "bold|"
-            if flags & 2**1: style += "italic|"
-            if flags & 2**2: style += "serif|"
-            if flags & 2**3: style += "mono|"
-            font_styles[style] += 1
+        # Analyze font styles: the low nibble of the span flags packs the
+        # bold (1), italic (2), serif (4) and mono (8) bits into one code,
+        # so a 16-bin count indexed by that code is the style histogram
+        flags_arr = np.asarray(flags, dtype=np.int32)
+        font_styles = np.bincount(flags_arr & 0xF, minlength=16)
         
         return {
             "body_size": body_size,
             "size_map": size_map,
-            "font_styles": font_styles,
-            "raw_data": font_data
+            "font_styles": font_styles
         }
 
     def _get_title(self):
@@ -109,20 +148,29 @@ class RobustOutlineExtractor:
             if clean_title:
                 return clean_title
         
-        # 2. Extract from first page's largest text
+        # 2. Extract the largest text from the top of the first page
         try:
-            page = self.doc[0]
-            blocks = page.get_text("dict", sort=True)["blocks"]
+            pdict = self._page_dict(0)
+            # Titles sit in the header region; blocks below it are body/headings
+            cutoff_y = pdict["height"] * TITLE_REGION
             candidate = None
             max_size = 0
+            top_y = cutoff_y
             
-            for block in blocks:
-                if "lines" in block:
-                    for line in block["lines"]:
-                        for span in line["spans"]:
-                            if span["size"] > max_size:
-                                max_size = span["size"]
-                                candidate = span["text"]
+            for block in pdict["blocks"]:
+                # sort=True orders blocks by their bottom edge, not their top,
+                # so skip rather than stop at the first block below the cutoff
+                if block["bbox"][1] > cutoff_y or "lines" not in block:
+                    continue
+                for line in block["lines"]:
+                    for span in line["spans"]:
+                        size = span["size"]
+                        y = span["bbox"][1]
+                        # Prefer the larger span; on equal size, the topmost
+                        if size > max_size or (size == max_size and y < top_y):
+                            max_size = size
+                            top_y = y
+                            candidate = span["text"]
             if candidate:
                 return self._clean_text(candidate)
         except:
@@ -136,36 +184,29 @@ class RobustOutlineExtractor:
         outline = []
         for level, title, page in self.toc:
             if 1 <= level <= 3:
+                text = title.strip()
+                # Well-tagged ToC titles are usually clean already
+                if _NEEDS_CLEANING.search(text):
+                    text = self._clean_text(text)
                 outline.append({
-                    "level": f"H{level}",
-                    "text": self._clean_text(title),
+                    "level": _LEVELS[level - 1],
+                    "text": text,
                     "page": max(0, page - 1)  # Convert to 0-based
                 })
         return outline
 
-    def _is_heading_candidate(self, text, font_size, font_flags, position, page_width):
+    def _is_heading_candidate(self, text, font_size, font_flags, center_x, left_thr, right_thr):
         """ML-inspired heading detection using multiple features"""
-        size_ratio = font_size / self.font_profiles["body_size"] if self.font_profiles["body_size"] > 0 else 1
-        is_bold = bool(font_flags & 2**0)
-        
-        heading_pattern = re.compile(
-            r'^(chapter|section|appendix|part|article|^\d+(\.\d+)*|^[A-Z]\.?)\b', 
-            re.IGNORECASE
-        )
-        has_numbering = bool(heading_pattern.match(text))
-        
-        is_centered = (position[0] > page_width * 0.3 and 
-                       position[1] < page_width * 0.7)
-        
-        is_title_case = text.istitle() or text.isupper()
+        # Weighted sum of boolean features; bool * weight avoids an if-ladder
+        inv_body_size = self._inv_body_size
+        size_ratio = font_size * inv_body_size if inv_body_size else 1.0
         
-        score = 0
-        score += min(3, size_ratio) * 1.5
-        score += 1.0 if is_bold else 0
-        score += 0.8 if has_numbering else 0
-        score += 0.6 if is_centered else 0
-        score += 0.5 if is_title_case else 0
-        score += 0.4 if len(text) < 80 else -0.2
+        score = (min(3, size_ratio) * 1.5
+                 + (font_flags & 1)  # bold bit
+                 + 0.8 * bool(_HEADING_RE.match(text))
+                 + 0.6 * (left_thr < center_x < right_thr)  # centered
+                 + 0.5 * (text.istitle() or text.isupper())
+                 + (0.4 if len(text) < 80 else -0.2))
         
         return score > 3.0
 
@@ -177,36 +218,51 @@ class RobustOutlineExtractor:
         outline = []
         size_map = self.font_profiles.get("size_map", {})
         
-        for p_num, page in enumerate(self.doc):
-            page_width = page.rect.width
-            blocks = page.get_text("dict", sort=True).get("blocks", [])
+        for p_num in range(len(self.doc)):
+            pdict = self._page_dict(p_num)
+            # The text dict carries the page size, so the page isn't reloaded
+            page_width = pdict["width"]
+            # A line counts as centered when its midpoint is in the middle 40%
+            left_thr = page_width * 0.3
+            right_thr = page_width * 0.7
+            blocks = pdict.get("blocks", [])
             
             for block in blocks:
                 if "lines" in block:
                     for line in block["lines"]:
-                        line_text = ""
-                        max_size = 0
-                        font_flags = 0
-                        bbox = line["bbox"]
+                        spans = line["spans"]
+                        if not spans:
+                            continue
                         
-                        for span in line["spans"]:
-                            line_text += span["text"]
-                            if span["size"] > max_size:
-                                max_size = span["size"]
+                        # Single pass: gather text and find the dominant span
+                        parts = []
+                        max_size = 0.0
+                        font_flags = 0
+                        for span in spans:
+                            parts.append(span["text"])
+                            size = span["size"]
+                            if size > max_size:
+                                max_size = size
                                 font_flags = span["flags"]
                         
+                        # Cleaning never lengthens text, so skip it for short lines
+                        line_text = "".join(parts)
+                        if len(line_text) < 3:
+                            continue
                         clean_text = self._clean_text(line_text)
-                        if not clean_text or len(clean_text) < 3:
+                        if len(clean_text) < 3:
                             continue
                         
+                        bbox = line["bbox"]
                         center_x = (bbox[0] + bbox[2]) / 2
                         
                         if self._is_heading_candidate(
                             clean_text, 
                             max_size, 
                             font_flags, 
-                            (center_x, page_width),
-                            page_width
+                            center_x,
+                            left_thr,
+                            right_thr
                         ):
                             level = "H3"
                             for lvl, size in size_map.items():
@@ -220,9 +276,15 @@ class RobustOutlineExtractor:
                                 "page": p_num
                             })
         
-        seen = set()
-        return [item for item in outline 
-                if not (item["text"] in seen or seen.add(item["text"]))]
+        # Keep the first occurrence of each heading text, preserving order
+        seen = {}
+        deduped = []
+        for item in outline:
+            text = item["text"]
+            if text not in seen:
+                seen[text] = True
+                deduped.append(item)
+        return deduped
 
     def get_structured_outline(self):
         """Generate final structured outline"""
@@ -232,62 +294,14 @@ class RobustOutlineExtractor:
         else:
             outline = self._extract_headings_heuristic()
         
+        # Release the cached page dicts; they can be large on long documents
+        self._pages_dict = None
+        
         return {
             "title": title,
             "outline": outline
         }
 
 
-def process_pdf(input_pdf, output_json):
-    """Process PDF and save outline to JSON with error handling"""
-    try:
-        extractor = RobustOutlineExtractor(input_pdf)
-        result = extractor.get_structured_outline()
-        
-        with open(output_json, 'w', encoding='utf-8') as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
-        
-        return True
-    except Exception as e:
-        print(f"Error processing {input_pdf}: {str(e)}")
-        with open(output_json, 'w', encoding='utf-8') as f:
-            json.dump({
-                "title": "Extraction Failed",
-                "outline": [],
-                "error": str(e)
-            }, f, indent=2)
-        return False
-
-
-if __name__ == "__main__":
-    INPUT_DIR = os.getenv("INPUT_DIR", "/app/input")
-    OUTPUT_DIR = os.getenv("OUTPUT_DIR", "/app/output")
-    
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    os.chmod(OUTPUT_DIR, 0o777)
-    
-    processed_count = 0
-    start_time = time.time()
-    
-    for filename in os.listdir(INPUT_DIR):
-        if filename.lower().endswith('.pdf'):
-            input_path = os.path.join(INPUT_DIR, filename)
-            output_path = os.path.join(
-                OUTPUT_DIR, 
-                f"{os.path.splitext(filename)[0]}.json"
-            )
-            
-            print(f"Processing '{filename}'...")
-            file_start = time.time()
-            
-            success = process_pdf(input_path, output_path)
-            elapsed = time.time() - file_start
-            
-            if success:
-                print(f"✓ Created '{os.path.basename(output_path)}' in {elapsed:.2f}s")
-                processed_count += 1
-            else:
-                print(f"✗ Failed to process '{filename}'")
-    
-    total_time = time.time() - start_time
-    print(f"\nProcessed {processed_count} files in {total_time:.2f} seconds")
+# Public name used by main.py
+OutlineExtractor = RobustOutlineExtractor